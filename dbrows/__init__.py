@@ -1,4 +1,9 @@
 # -*- coding: utf-8 -*-
+import io
+import itertools
+import sys
+import threading
+import time
 from collections import OrderedDict
 
 
@@ -6,6 +11,10 @@ class WrongOperationError(Exception):
     pass
 
 
+class ResultTooLargeError(Exception):
+    pass
+
+
 class Row(object):
     """A row from a database.
 
@@ -92,6 +101,27 @@ class RowCollection(object):
     Only the row returned by the `first` property is cached,
     all other data is not.
 
+    With `prefetch` set, the iteration fetches the next batches of rows
+    in a background thread, while the current one is processed.
+    This helps only when fetching waits for the database, so `Database.query`
+    uses a server side cursor for it on PostgreSQL. The batches are larger,
+    so passing them between the threads costs less than fetching them.
+
+    With `max_bytes` set, the collection keeps track of the approximate size
+    of the rows it holds in memory: the cached first row, the batch being
+    iterated, and the prefetched batches. The batches are made smaller to fit
+    in the limit once the size of a row is known. With a `buffered` cursor,
+    which gets all the rows in execute(), like a PostgreSQL client side cursor,
+    the size of the rows left in the cursor is also counted, it's estimated
+    using the rows fetched so far.
+
+    When the size exceeds the limit, `ResultTooLargeError` is raised.
+    With `spill` set, the rows left in a buffered cursor are moved
+    to a temporary file instead, the cursor is closed to free its memory,
+    and the next rows are read from the file. A streamed cursor holds only
+    the fetched rows, so moving them to a file wouldn't save any memory,
+    and the error is raised also with `spill`.
+
 
 
     Examples
@@ -103,14 +133,51 @@ class RowCollection(object):
 
     """
 
-    def __init__(self, cursor, col_names):
+    # Number of rows fetched from the cursor at once while iterating,
+    # and while iterating with prefetching, or from a server side cursor.
+    FETCH_SIZE = 10
+    BATCH_FETCH_SIZE = 1000
+
+    def __init__(self, cursor, col_names, prefetch=0, max_bytes=None, spill=False,
+                 fetch_size=None, buffered=False):
         """
         Args:
             cursor (DBAPI.connection.cursor): Opened database cursor with the query results.
             col_names (List[str]): Names of the columns returned by the query.
+                                   None if they should be read from the cursor after
+                                   the first fetch, like for server side cursors.
+            prefetch (int): Number of batches fetched ahead in a background thread
+                            while iterating, 0 turns the prefetching off.
+            max_bytes (int): Max approximate size of the rows kept in memory,
+                             None turns the tracking off.
+            spill (bool): True if the rows should be moved to a temporary file
+                          when `max_bytes` is exceeded, instead of raising an error.
+                          Used only with a `buffered` cursor.
+            fetch_size (int): Number of rows fetched at once while iterating,
+                              by default it depends on `prefetch`.
+            buffered (bool): True if the cursor holds all the rows in memory
+                             after the query.
         """
         self._cursor = cursor
         self._col_names = col_names
+        self._prefetch = prefetch
+        if fetch_size is None:
+            fetch_size = self.BATCH_FETCH_SIZE if prefetch else self.FETCH_SIZE
+        self._fetch_size = fetch_size
+
+        self._max_bytes = max_bytes
+        self._spill = spill
+        self._buffered = buffered
+        self._done = False  # True when all the rows are read from the cursor
+        self._spill_file = None
+        self._spilled_rows = []  # rows loaded from the spill file, but not returned yet
+        self._bytes_lock = threading.Lock()  # the prefetching thread also fetches rows
+        self._held_bytes = 0
+        self._cached_bytes = 0
+        self._cursor_bytes = 0  # estimated size of the rows left in a buffered cursor
+        self._peak_bytes = 0
+        self._measured_rows = 0
+        self._measured_bytes = 0
 
         self._size = self._cursor.rowcount
         self._pending = self._cursor.rowcount
@@ -135,11 +202,13 @@ class RowCollection(object):
             When called multiple times, it returns the same data.
         """
         if not self._got_first:
-            data = self._cursor.fetchone()
+            rows, nbytes = self._fetch(1)
+            self._cached_bytes = nbytes
+            data = rows[0] if rows else None
             self._got_first = True
             if data:
                 self._pending -= 1
-                self._first_row = Row(col_names=self._col_names, values=data)
+                self._first_row = Row(col_names=self._names(), values=data)
             else:
                 self._first_row = None
 
@@ -151,12 +220,225 @@ class RowCollection(object):
         return self._pending
 
     def __iter__(self):
+        if self._prefetch:
+            batches = self._prefetched_batches()
+        else:
+            batches = self._fetched_batches()
+        for rows, nbytes in batches:
+            try:
+                for row in rows:
+                    yield Row(col_names=self._names(), values=row)
+            finally:
+                self._release(nbytes)
+
+    def _names(self):
+        """tuple: Names of the columns, read from the cursor if not known yet."""
+        if self._col_names is None and self._cursor.description is not None:
+            self._col_names = tuple([col[0] for col in self._cursor.description])
+        return self._col_names
+
+    @property
+    def peak_bytes(self):
+        """int: The highest approximate size of the rows held in memory.
+
+        It's tracked only when `max_bytes` is set.
+        """
+        return self._peak_bytes
+
+    @property
+    def spilled(self):
+        """bool: True if the rows were moved to a temporary file."""
+        return self._spill_file is not None
+
+    def _fetched_batches(self):
+        """Yields the batches of raw rows fetched from the cursor, with their sizes."""
         while True:
-            self._rows = self._cursor.fetchmany(10)
-            if not self._rows:
+            rows, nbytes = self._fetch(self._batch_size())
+            if not rows:
                 break
-            for row in self._rows:
-                yield Row(col_names=self._col_names, values=row)
+            yield rows, nbytes
+
+    def _batch_size(self):
+        """int: Number of rows fetched at once.
+
+        With `max_bytes` set, the first row is fetched alone to measure it,
+        then the batches held at once should fit in the limit, together with
+        the cached first row, and the rows left in the cursor. While prefetching
+        these are the iterated batch, the queued ones, and the one waiting
+        for a place in the queue.
+        """
+        if self._max_bytes is None:
+            return self._fetch_size
+        if not self._measured_rows:
+            return 1
+        row_bytes = self._measured_bytes / self._measured_rows
+        batches = self._prefetch + 2 if self._prefetch else 1
+        budget = max(self._max_bytes - self._cached_bytes - self._cursor_bytes, 0) / batches
+        return max(1, min(self._fetch_size, int(budget / row_bytes)))
+
+    def _measure(self, rows):
+        """int: Approximate size of the rows in memory."""
+        return sum(_row_size(row) for row in rows)
+
+    def _hold(self, nbytes, transient=0):
+        """Adds the bytes to the size held in memory.
+
+        Args:
+            nbytes (int): Size of the rows kept until they are released.
+            transient (int): Size of the rows kept only for a moment.
+
+        Returns:
+            int: The size held in memory.
+        """
+        with self._bytes_lock:
+            self._held_bytes += nbytes
+            self._peak_bytes = max(self._peak_bytes, self._held_bytes + transient)
+            return self._held_bytes
+
+    def _release(self, nbytes):
+        """Subtracts the bytes of the processed rows from the size held in memory."""
+        if nbytes:
+            with self._bytes_lock:
+                self._held_bytes -= nbytes
+
+    def _fetch(self, size):
+        """Fetches the next raw rows, and tracks their size.
+
+        Args:
+            size (int): Max number of the rows.
+
+        Returns:
+            Tuple[List[tuple], int]: The rows, empty when there are no more rows,
+                                     and the size to release when they are processed.
+
+        Raises:
+            ResultTooLargeError if the rows exceed `max_bytes`, and `spill` is not set.
+        """
+        if self._spill_file is not None:
+            return self._read_spilled(size)
+        if self._done:
+            return [], 0
+
+        rows = self._cursor.fetchmany(size)
+        if not rows:
+            # frees the cursor also on the server, like a PostgreSQL cursor WITH HOLD
+            self._names()
+            self._cursor.close()
+            self._done = True
+            self._release(self._cursor_bytes)
+            self._cursor_bytes = 0
+            return rows, 0
+        if self._max_bytes is None:
+            return rows, 0
+
+        nbytes = self._measure(rows)
+        self._measured_rows += len(rows)
+        self._measured_bytes += nbytes
+        if self._hold(nbytes + self._measure_cursor()) > self._max_bytes:
+            if not (self._spill and self._buffered):
+                self._release(nbytes)
+                raise ResultTooLargeError(
+                    "The query result takes more than {} bytes of memory.".format(self._max_bytes))
+            self._spill_rows()
+        return rows, nbytes
+
+    def _measure_cursor(self):
+        """Estimates the size of the rows left in a buffered cursor.
+
+        Returns:
+            int: Change of the size since the previous estimation.
+        """
+        if not self._buffered:
+            return 0
+        left = max(self._size - self._measured_rows, 0)
+        cursor_bytes = int(self._measured_bytes / self._measured_rows * left)
+        change = cursor_bytes - self._cursor_bytes
+        self._cursor_bytes = cursor_bytes
+        return change
+
+    def _spill_rows(self):
+        """Moves the rows left in the cursor to a temporary file, and closes the cursor."""
+        import pickle
+        import tempfile
+
+        self._spill_file = tempfile.TemporaryFile()
+        while True:
+            rows = self._cursor.fetchmany(self._fetch_size)
+            if not rows:
+                break
+            self._hold(0, transient=self._measure(rows))
+            pickle.dump(rows, self._spill_file, pickle.HIGHEST_PROTOCOL)
+        self._names()
+        self._cursor.close()
+        self._release(self._cursor_bytes)
+        self._cursor_bytes = 0
+        self._spill_file.seek(0)
+
+    def _read_spilled(self, size):
+        """Returns up to `size` next rows from the spill file, and their size.
+
+        The file is read in the batches it was written in, the rows of a batch
+        are held in memory until they are returned.
+        """
+        import pickle
+
+        if not self._spilled_rows and not self._spill_file.closed:
+            try:
+                self._spilled_rows = pickle.load(self._spill_file)
+            except EOFError:
+                self._spill_file.close()
+            self._hold(self._measure(self._spilled_rows))
+        rows = self._spilled_rows[:size]
+        self._spilled_rows = self._spilled_rows[size:]
+        return rows, self._measure(rows)
+
+    def _prefetched_batches(self):
+        """Yields the batches of raw rows fetched by a background thread.
+
+        The thread keeps up to `prefetch` batches in a queue. It's stopped
+        when the iteration ends, also when it's stopped early.
+        Errors raised while fetching are raised here.
+        """
+        import queue
+
+        batches = queue.Queue(maxsize=self._prefetch)
+        stop = threading.Event()
+
+        def put(item):
+            """bool: True if the item was queued, False if the iteration stopped."""
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def fetch():
+            try:
+                for rows, nbytes in self._fetched_batches():
+                    if not put((rows, nbytes, None)):
+                        self._release(nbytes)
+                        return
+                put(([], 0, None))
+            except Exception as e:
+                put((None, 0, e))
+
+        thread = threading.Thread(target=fetch, daemon=True)
+        thread.start()
+        try:
+            while True:
+                rows, nbytes, error = batches.get()
+                if error is not None:
+                    raise error
+                if not rows:
+                    break
+                yield rows, nbytes
+        finally:
+            stop.set()
+            thread.join()
+            while not batches.empty():
+                self._release(batches.get()[1])
 
     @property
     def size(self):
@@ -164,6 +446,194 @@ class RowCollection(object):
         return self._size
 
 
+def _row_size(row):
+    """int: Approximate size of a raw row in memory."""
+    return sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row)
+
+
+def _encode_value(value):
+    """Encodes a watermark or key value, so it can be saved as JSON."""
+    import datetime
+    from decimal import Decimal
+
+    if isinstance(value, datetime.datetime):
+        offset = value.utcoffset()
+        return {
+            'datetime': list(value.timetuple()[:6]) + [value.microsecond],
+            'utcoffset': None if offset is None else offset.total_seconds(),
+        }
+    if isinstance(value, datetime.date):
+        return {'date': [value.year, value.month, value.day]}
+    if isinstance(value, Decimal):
+        return {'decimal': str(value)}
+    return value
+
+
+def _decode_value(value):
+    """Decodes a value encoded with `_encode_value`."""
+    import datetime
+    from decimal import Decimal
+
+    if not isinstance(value, dict):
+        return value
+    if 'datetime' in value:
+        tzinfo = None
+        if value['utcoffset'] is not None:
+            tzinfo = datetime.timezone(datetime.timedelta(seconds=value['utcoffset']))
+        return datetime.datetime(*value['datetime'], tzinfo=tzinfo)
+    if 'date' in value:
+        return datetime.date(*value['date'])
+    return Decimal(value['decimal'])
+
+
+class ConnectionStats(object):
+    """Statistics of the attempts to connect to a database.
+
+    All the times are in seconds.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._attempts = 0
+        self._failures = 0
+        self._reconnects = 0
+        self._total_time = 0.0
+        self._last_time = None
+        self._max_time = 0.0
+
+    def _record(self, duration, failed):
+        with self._lock:
+            self._attempts += 1
+            if failed:
+                self._failures += 1
+            self._total_time += duration
+            self._last_time = duration
+            self._max_time = max(self._max_time, duration)
+
+    def _record_reconnect(self):
+        with self._lock:
+            self._reconnects += 1
+
+    def __repr__(self):
+        return "<ConnectionStats attempts={} failures={} reconnects={}>".\
+            format(self._attempts, self._failures, self._reconnects)
+
+    @property
+    def attempts(self):
+        """int: Number of the connection attempts."""
+        return self._attempts
+
+    @property
+    def failures(self):
+        """int: Number of the failed connection attempts."""
+        return self._failures
+
+    @property
+    def reconnects(self):
+        """int: Number of the dead connections replaced with new ones."""
+        return self._reconnects
+
+    @property
+    def last_time(self):
+        """float or None: Duration of the last connection attempt."""
+        return self._last_time
+
+    @property
+    def max_time(self):
+        """float: Duration of the slowest connection attempt."""
+        return self._max_time
+
+    @property
+    def avg_time(self):
+        """float or None: Average duration of a connection attempt."""
+        if not self._attempts:
+            return None
+        return self._total_time / self._attempts
+
+    @property
+    def as_dict(self):
+        """dict: All the statistics as a dictionary."""
+        return OrderedDict([
+            ('attempts', self.attempts),
+            ('failures', self.failures),
+            ('reconnects', self.reconnects),
+            ('last_time', self.last_time),
+            ('max_time', self.max_time),
+            ('avg_time', self.avg_time),
+        ])
+
+
+class _ExportWriter(object):
+    """File-like object used by `Database.export`.
+
+    Keeps the written data in a buffer of a fixed size,
+    and reports the progress every time the buffer is flushed.
+    """
+
+    def __init__(self, fileobj, buffer_size, progress=None):
+        """
+        Args:
+            fileobj (file): File object the data is written to.
+            buffer_size (int): Size of the buffer.
+            progress (Callable[[int], None]): Called with the number of
+                                              already written bytes.
+        """
+        self._fileobj = fileobj
+        self._buffer_size = buffer_size
+        self._progress = progress
+        self._buffer = []
+        self._buffered = 0
+        self._written = 0
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self._buffer_size:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if not self._buffer:
+            return
+        self._fileobj.write(self._buffer[0][:0].join(self._buffer))
+        self._written += self._buffered
+        self._buffer = []
+        self._buffered = 0
+        if self._progress is not None:
+            self._progress(self._written)
+
+    @property
+    def written(self):
+        """int: Number of bytes written to the file object."""
+        return self._written + self._buffered
+
+
+class _ExportTextWriter(_ExportWriter, io.TextIOBase):
+    """The `_ExportWriter` for text files.
+
+    The drivers check the type of the file object to find out
+    if they should write `str` or `bytes`.
+    """
+
+    def close(self):
+        # nothing to close, the wrapped file object belongs to the caller
+        pass
+
+
+class _ConnectionState(object):
+    """The connection used by a `Database`, and its transaction state."""
+
+    def __init__(self):
+        self.connection = None
+        self.transaction_depth = 0
+        self.in_transaction = False  # driver's transaction state after the last query
+        self.has_writes = False  # True if the open transaction has run other queries than SELECT
+
+
+class _ThreadConnectionState(_ConnectionState, threading.local):
+    """The `_ConnectionState` kept separately for each thread."""
+
+
 class Transaction(object):
     """Database transaction."""
 
@@ -187,11 +657,13 @@ class Transaction(object):
         self._closed = False
 
     def __enter__(self):
+        self._database._state.transaction_depth += 1
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
 
         self._closed = True
+        self._database._state.transaction_depth -= 1
 
         if exc_type:
             self._database.rollback()
@@ -244,67 +716,797 @@ class Database(object):
     """Connection to a database.
     """
 
-    def __init__(self, connstr):
+    # Default number of keys sent in one `fetch_by_keys` query.
+    # PostgreSQL gets all the keys as one array parameter,
+    # SQLite has a limit of 999 host parameters in one statement.
+    PG_KEYS_CHUNK = 5000
+    SQLITE_MAX_PARAMS = 999
+
+    # Size of the buffer used by `export`, and number of rows
+    # fetched in one batch when the database doesn't support COPY.
+    EXPORT_BUFFER_SIZE = 64 * 1024
+    EXPORT_BATCH_SIZE = 1000
+
+    # Query used for checking if a connection works.
+    VALIDATION_QUERY = "SELECT 1"
+
+    def __init__(self, connstr, lazy=False, prewarm=False,
+                 reconnect_attempts=0, reconnect_delay=0.1, reconnect_max_delay=5.0,
+                 thread_safe=False, max_result_bytes=None, spill=False):
         """
 
         Args:
              connstr (str): Connection string to a database.
+             lazy (bool): True if the connection should be opened on the first use,
+                          not in the constructor.
+             prewarm (bool): True if the connection should be opened, and checked
+                             with a cheap query in a background thread.
+                             Makes sense only with `lazy`.
+             reconnect_attempts (int): How many times a dead connection is reopened
+                                       before giving up. Only reading queries
+                                       run outside a transaction are repeated,
+                                       when no uncommitted changes would be lost.
+             reconnect_delay (float): Seconds to wait before the first reconnect,
+                                      doubled for each next attempt.
+             reconnect_max_delay (float): Max seconds to wait before a reconnect.
+             thread_safe (bool): True if the object can be shared between threads.
+                                 Each thread gets its own connection, and its own
+                                 transactions. Connections of finished threads
+                                 are reused by the new ones.
+             max_result_bytes (int): Default max approximate size of a query result
+                                     kept in memory, None means no limit.
+             spill (bool): True if a query result exceeding `max_result_bytes` should
+                           be moved to a temporary file, instead of raising
+                           `ResultTooLargeError`.
         """
         self._connstr = connstr
         self._open = True
-        self._col_names = None
+        self._engine = None
+        self._reconnect_attempts = reconnect_attempts
+        self._reconnect_delay = reconnect_delay
+        self._reconnect_max_delay = reconnect_max_delay
+        self._thread_safe = thread_safe
+        self._max_result_bytes = max_result_bytes
+        self._spill = spill
+        self._stats = ConnectionStats()
 
         if self._connstr.startswith('postgresql://'):
             import psycopg2 as dbapi
             self._dbapi = dbapi
+            self._engine = 'postgresql'
         elif self._connstr.startswith('sqlite://'):
             import sqlite3 as dbapi
             self._dbapi = dbapi
+            self._engine = 'sqlite'
             self._connstr = self._connstr.replace('sqlite://', '')
 
-        self._connection = self._dbapi.connect(self._connstr)
+        self._cursor_ids = itertools.count()  # for naming server side cursors
+        self._spare_lock = threading.Lock()
+        self._spare_connections = []  # idle connections used by parallel lookups
+
+        self._connection_lock = threading.Lock()
+        self._state = _ThreadConnectionState() if thread_safe else _ConnectionState()
+        self._thread_connections = []  # (thread, connection) pairs in the thread safe mode
+        self._prewarm_thread = None
+
+        if not lazy:
+            self._get_connection()
+        elif prewarm:
+            self._prewarm_thread = threading.Thread(target=self._prewarm, daemon=True)
+            self._prewarm_thread.start()
+
+    def _connect(self):
+        """Opens a new DBAPI connection."""
+        start = time.perf_counter()
+        try:
+            if self._engine == 'sqlite':
+                # the connection can be handed over to worker threads
+                connection = self._dbapi.connect(self._connstr, check_same_thread=False)
+            else:
+                connection = self._dbapi.connect(self._connstr)
+        except Exception:
+            self._stats._record(time.perf_counter() - start, failed=True)
+            raise
+        self._stats._record(time.perf_counter() - start, failed=False)
+        return connection
+
+    @property
+    def _connection(self):
+        """DBAPI.connection or None: Connection of the calling thread."""
+        return self._state.connection
+
+    def _get_connection(self):
+        """Returns the connection, opens it if it's not opened yet."""
+        state = self._state
+        if state.connection is None:
+            if self._thread_safe:
+                # the state belongs to the calling thread, no other thread can set it
+                state.connection = self._open_thread_connection()
+            else:
+                with self._connection_lock:
+                    if state.connection is None:
+                        state.connection = self._connect()
+        return state.connection
+
+    def _open_thread_connection(self):
+        """Opens a connection for the calling thread in the thread safe mode.
+
+        The connection is taken from the idle ones if possible. The new connection
+        is opened without holding the `_connection_lock`.
+        """
+        with self._connection_lock:
+            alive = []
+            finished = []
+            for thread, connection in self._thread_connections:
+                if thread.is_alive():
+                    alive.append((thread, connection))
+                else:
+                    finished.append(connection)
+            self._thread_connections = alive
+        for connection in finished:
+            self._release_spare_connection(connection)
+
+        with self._spare_lock:
+            connection = self._spare_connections.pop() if self._spare_connections else None
+        if connection is None:
+            connection = self._connect()
+        with self._connection_lock:
+            self._thread_connections.append((threading.current_thread(), connection))
+        return connection
+
+    def _forget_connection(self, connection):
+        """Removes the connection from the connections used by threads."""
+        self._thread_connections = [
+            (thread, used) for thread, used in self._thread_connections
+            if used is not connection]
+
+    def _prewarm(self):
+        """Opens the connection, and checks it with a cheap query.
+
+        The connection is used only after it's checked. In the thread safe mode
+        it's kept for the first thread using it. When the connection was already
+        opened by the first use, the checked one is closed.
+        Errors are ignored, they are counted in the connection stats,
+        and the connection will be opened again on the first use.
+        """
+        try:
+            connection = self._connect()
+            connection.cursor().execute(self.VALIDATION_QUERY)
+            connection.rollback()
+        except Exception:
+            return
+
+        if self._thread_safe:
+            self._release_spare_connection(connection)
+            return
+
+        with self._connection_lock:
+            if self._state.connection is None:
+                self._state.connection = connection
+                return
+        connection.close()
+
+    def _is_alive(self, connection):
+        """bool: False if the connection is dead, and needs to be opened again."""
+        closed = getattr(connection, 'closed', None)
+        if closed is not None:
+            # psycopg2 sets it to a non zero value for a closed connection
+            return not closed
+        try:
+            connection.cursor().execute(self.VALIDATION_QUERY)
+        except self._dbapi.Error:
+            return False
+        return True
+
+    def _reconnect(self, dead_connection):
+        """Replaces the dead connection with a new one.
+
+        Waits with exponential backoff between the attempts. The waiting and
+        connecting is done without holding the `_connection_lock`, so other
+        threads can open their connections in the meantime.
+
+        Returns:
+            DBAPI.connection: The new connection.
+
+        Raises:
+            The error from the last connection attempt.
+        """
+        state = self._state
+        with self._connection_lock:
+            if state.connection is not None and state.connection is not dead_connection:
+                # another thread has already reconnected
+                return state.connection
+            if state.connection is dead_connection:
+                self._forget_connection(dead_connection)
+                state.connection = None
+        try:
+            dead_connection.close()
+        except self._dbapi.Error:
+            pass
+
+        delay = self._reconnect_delay
+        for attempt in range(self._reconnect_attempts):
+            time.sleep(delay)
+            delay = min(delay * 2, self._reconnect_max_delay)
+            try:
+                connection = self._connect()
+            except self._dbapi.Error:
+                if attempt == self._reconnect_attempts - 1:
+                    raise
+                continue
+
+            with self._connection_lock:
+                if state.connection is None:
+                    state.connection = connection
+                    if self._thread_safe:
+                        self._thread_connections.append((threading.current_thread(), connection))
+                    self._stats._record_reconnect()
+                    return connection
+            # another thread has opened the shared connection in the meantime
+            connection.close()
+            return state.connection
+
+    def _in_transaction(self, connection):
+        """bool: True if the driver has started a transaction on the connection.
+
+        The drivers start transactions implicitly, also outside the `transaction` blocks.
+        For a closed, or broken connection it's the state left by the last query.
+        """
+        try:
+            if self._engine == 'postgresql':
+                from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN
+                status = connection.info.transaction_status
+                if status == TRANSACTION_STATUS_UNKNOWN:
+                    return self._state.in_transaction
+                return status != TRANSACTION_STATUS_IDLE
+            return connection.in_transaction
+        except self._dbapi.Error:
+            return self._state.in_transaction
+
+    def _has_uncommitted_writes(self, connection):
+        """bool: True if the open transaction has run other queries than SELECT.
+
+        PostgreSQL starts a transaction also for a SELECT, losing such a transaction
+        loses nothing. Only the queries made with `query` are tracked.
+        """
+        return self._state.has_writes and self._in_transaction(connection)
+
+    def _is_read_query(self, query_str):
+        """bool: True if the query is a SELECT."""
+        words = query_str.split(None, 1)
+        return bool(words) and words[0].upper() == 'SELECT'
+
+    def _can_retry(self, query_str, has_writes):
+        """bool: True if the query can be repeated after reconnecting.
+
+        Args:
+            query_str (str): SQL query
+            has_writes (bool): True if the transaction open before the query has
+                               uncommitted changes, they would be lost with the connection.
+        """
+        return (self._reconnect_attempts > 0
+                and not has_writes
+                and self._state.transaction_depth == 0
+                and self._is_read_query(query_str))
+
+    @property
+    def connection_stats(self):
+        """ConnectionStats: Statistics of the connection attempts."""
+        return self._stats
+
+    @property
+    def _placeholder(self):
+        """str: Placeholder for a query parameter used by the driver."""
+        return '?' if self._dbapi.paramstyle == 'qmark' else '%s'
 
     @property
     def is_open(self):
         """bool : True if the connection is open, False otherwise"""
         return self._open
 
-    def query(self, query_str, *params):
+    def query(self, query_str, *params, prefetch=0, max_result_bytes=None, spill=None):
         """Makes a query, and returns the results.
 
         Args:
             query_str (str): SQL query
             *params (*args): params for the query
+            prefetch (int): Number of row batches fetched ahead in a background
+                            thread while iterating the results.
+            max_result_bytes (int): Max approximate size of the results kept in memory,
+                                    by default the one set for the database.
+            spill (bool): True if the results exceeding `max_result_bytes` should be
+                          moved to a temporary file, by default the one set for the database.
 
         Returns:
             RowCollection: Collection of the rows.
                            If the query didn't return any row,
                            then the returned RowCollection has no rows.
+
+        Notes:
+            With `prefetch`, or `max_result_bytes` passed to this call, on PostgreSQL
+            a SELECT is read with a server side cursor, so `size` of the results is -1,
+            like on SQLite. The cursor is declared WITH HOLD, so the rows can be
+            still read after a commit. The limit set for the database doesn't change
+            the cursor, the rows are loaded by the query, and `spill` can move them
+            to a temporary file.
         """
-        cursor = self._connection.cursor()
+        stream = max_result_bytes is not None
+        options = dict(
+            prefetch=prefetch,
+            max_bytes=self._max_result_bytes if max_result_bytes is None else max_result_bytes,
+            spill=self._spill if spill is None else spill,
+        )
+        connection = self._get_connection()
+        has_writes = self._has_uncommitted_writes(connection)
+        try:
+            rows = self._execute(connection, query_str, params, stream, **options)
+        except self._dbapi.Error:
+            if not self._can_retry(query_str, has_writes) or self._is_alive(connection):
+                raise
+            connection = self._reconnect(connection)
+            has_writes = False
+            rows = self._execute(connection, query_str, params, stream, **options)
+        state = self._state
+        state.in_transaction = self._in_transaction(connection)
+        state.has_writes = state.in_transaction and (has_writes or not self._is_read_query(query_str))
+        return rows
+
+    def _execute(self, connection, query_str, params, stream=False, **options):
+        """Runs the query using the connection.
+
+        Args:
+            stream (bool): True if the rows should be streamed, when it's possible.
+            options (**kwargs): Options for the returned `RowCollection`.
+
+        Returns:
+            RowCollection: Collection of the rows.
+        """
+        if (stream or options.get('prefetch')) and self._use_server_cursor(query_str):
+            # the rows are sent by the server when fetched, not all at once in execute(),
+            # the column names are known after the first fetch,
+            # WITH HOLD keeps the cursor open after a commit made while iterating
+            cursor = connection.cursor(name="dbrows_{}".format(next(self._cursor_ids)),
+                                       withhold=True)
+            cursor.execute(query_str, tuple(params))
+            return RowCollection(cursor=cursor, col_names=None,
+                                 fetch_size=RowCollection.BATCH_FETCH_SIZE, **options)
+
+        cursor = connection.cursor()
         cursor.execute(query_str, tuple(params))
 
-        self._col_names = None
+        col_names = None
         if cursor.description is not None:
-            self._col_names = tuple([col.name for col in cursor.description])
-        return RowCollection(cursor=cursor, col_names=self._col_names)
+            col_names = tuple([col[0] for col in cursor.description])
+        return RowCollection(cursor=cursor, col_names=col_names,
+                             buffered=self._engine == 'postgresql', **options)
+
+    def _use_server_cursor(self, query_str):
+        """bool: True if the query results can be read with a server side cursor.
+
+        PostgreSQL client side cursors get all the rows in execute(), server side
+        ones fetch them in batches. Only the queries returning rows can be used.
+        """
+        first_word = query_str.lstrip().split(None, 1)[0].upper() if query_str.strip() else ''
+        return (self._engine == 'postgresql'
+                and first_word in ('SELECT', 'WITH', 'VALUES', 'TABLE'))
+
+    @property
+    def _private_database(self):
+        """bool: True if each connection opens a separate database, like in-memory SQLite."""
+        return self._engine == 'sqlite' and self._connstr in ('', ':memory:')
+
+    def fetch_by_keys(self, query_or_table, key_column, keys,
+                      chunk=None, many=False, workers=1, params=()):
+        """Fetches rows for many keys using a handful of queries.
+
+        This replaces calling `query` in a loop, once for each key.
+        The keys are deduplicated, and split into chunks. Each chunk is
+        fetched with one query using `= ANY(%s)` on PostgreSQL,
+        and an expanded `IN (...)` list on other databases.
+
+        Examples:
+            Load the users for all the orders:
+                users = db.fetch_by_keys('users', 'id', [o.user_id for o in orders])
+                users[42].name
+
+            Load all the orders for the users:
+                orders = db.fetch_by_keys(
+                    "SELECT * FROM orders WHERE status = %s", 'user_id',
+                    user_ids, many=True, params=('open',))
+
+        Notes:
+            With `workers` greater than 1 the chunks are fetched in parallel
+            using additional connections, which are kept for the next calls.
+            Those connections don't see the uncommitted changes
+            made with the main one. For an in-memory SQLite database
+            each connection would open a new, empty database,
+            so there the chunks are always fetched with the main connection.
+
+        Args:
+            query_or_table (str): Name of a table, or a query returning the rows.
+            key_column (str): Name of the column with the keys.
+            keys (Iterable): Keys to look up, they must be hashable.
+            chunk (int): Max number of keys sent in one query.
+                         By default it depends on the driver's parameter limits.
+            many (bool): True if there can be many rows for one key.
+            workers (int): Number of queries run in parallel.
+            params (tuple): Params for the `query_or_table` query.
+
+        Returns:
+            dict: Key -> Row, or key -> List[Row] if `many` is True.
+                  Keys without any row are not in the dictionary.
+
+        Raises:
+            ValueError if `chunk` or `workers` is lower than 1.
+        """
+        params = tuple(params)
+        if chunk is None:
+            if self._engine == 'postgresql':
+                chunk = self.PG_KEYS_CHUNK
+            else:
+                chunk = self.SQLITE_MAX_PARAMS - len(params)
+        if chunk < 1:
+            raise ValueError("The chunk size must be greater than 0.")
+        if workers < 1:
+            raise ValueError("The number of workers must be greater than 0.")
+
+        keys = list(OrderedDict.fromkeys(keys))
+        chunks = [keys[i:i + chunk] for i in range(0, len(keys), chunk)]
+
+        if len(query_or_table.split()) == 1:
+            source = query_or_table
+        else:
+            source = "({}) _dbrows_keys".format(query_or_table)
+
+        def make_query(chunk_keys):
+            if self._engine == 'postgresql':
+                query_str = "SELECT * FROM {} WHERE {} = ANY(%s)".format(source, key_column)
+                return query_str, params + (list(chunk_keys),)
+            placeholders = ", ".join([self._placeholder] * len(chunk_keys))
+            query_str = "SELECT * FROM {} WHERE {} IN ({})".format(source, key_column, placeholders)
+            return query_str, params + tuple(chunk_keys)
+
+        def fetch(connection, chunk_keys):
+            query_str, query_params = make_query(chunk_keys)
+            return [row for row in self._execute(connection, query_str, query_params)]
+
+        def fetch_parallel(chunk_keys):
+            connection = self._acquire_spare_connection()
+            try:
+                return fetch(connection, chunk_keys)
+            finally:
+                self._release_spare_connection(connection)
+
+        if workers == 1 or len(chunks) < 2 or self._private_database:
+            connection = self._get_connection()
+            results = [fetch(connection, chunk_keys) for chunk_keys in chunks]
+        else:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=min(workers, len(chunks))) as executor:
+                results = list(executor.map(fetch_parallel, chunks))
+
+        found = {}
+        for rows in results:
+            for row in rows:
+                key = row[key_column]
+                if many:
+                    found.setdefault(key, []).append(row)
+                else:
+                    found[key] = row
+        return found
+
+    def export(self, query_str, fileobj, *params, format='csv', header=False,
+               gzip=False, buffer_size=None, progress=None):
+        """Writes the query results to a file.
+
+        On PostgreSQL this uses `COPY (query) TO STDOUT`, and the data is streamed
+        from the database straight to the file, without creating any `Row` objects.
+        On other databases the rows are fetched in batches, and written
+        in the same format, only `csv` and `text` formats are supported there.
+
+        Examples:
+            Dump a table to a compressed csv file:
+                with open('users.csv.gz', 'wb') as f:
+                    db.export("SELECT * FROM users WHERE id > %s", f, 42,
+                              header=True, gzip=True)
+
+        Args:
+            query_str (str): SQL query
+            fileobj (file): File object the data is written to. It can be a text
+                            file for `csv` and `text` formats without `gzip`.
+            *params (*args): params for the query
+            format (str): `csv`, `text`, or `binary`, formats used by PostgreSQL COPY.
+            header (bool): True if the first line should contain the column names,
+                           works only for the `csv` format.
+            gzip (bool): True if the data should be compressed with gzip.
+            buffer_size (int): Size of the buffer for the written data.
+            progress (Callable[[int], None]): Called with the number of already
+                                              written bytes (before compression)
+                                              each time the buffer is flushed.
+
+        Returns:
+            int: Number of written bytes, before compression.
+                 For text files it's the number of characters.
+
+        Raises:
+            ValueError if the format or the options are wrong.
+            WrongOperationError if the format is not supported by the database.
+        """
+        if format not in ('csv', 'text', 'binary'):
+            raise ValueError("Unknown export format '{}'.".format(format))
+        if header and format != 'csv':
+            raise ValueError("The header can be exported only in the csv format.")
+
+        is_text = isinstance(fileobj, io.TextIOBase)
+        if is_text and (gzip or format == 'binary'):
+            raise ValueError("The {} data can be written only to a binary file."
+                             .format('compressed' if gzip else 'binary'))
+
+        if format == 'binary' and self._engine != 'postgresql':
+            raise WrongOperationError("The binary format is supported only on PostgreSQL.")
+
+        if buffer_size is None:
+            buffer_size = self.EXPORT_BUFFER_SIZE
+
+        target = fileobj
+        if gzip:
+            from gzip import GzipFile
+            target = GzipFile(fileobj=fileobj, mode='wb')
+
+        writer_class = _ExportTextWriter if is_text else _ExportWriter
+        writer = writer_class(target, buffer_size=buffer_size, progress=progress)
+
+        if self._engine == 'postgresql':
+            self._export_copy(query_str, params, writer, format, header)
+        else:
+            self._export_batches(query_str, params, writer, format, header, is_text)
+
+        writer.flush()
+        if gzip:
+            target.close()
+        return writer.written
+
+    def _export_copy(self, query_str, params, writer, format, header):
+        """Exports the query results using PostgreSQL COPY."""
+        options = "FORMAT {}".format(format)
+        if header:
+            options += ", HEADER true"
+        cursor = self._get_connection().cursor()
+        copy_str = cursor.mogrify("COPY ({}) TO STDOUT WITH ({})".format(query_str, options),
+                                  tuple(params))
+        cursor.copy_expert(copy_str, writer)
+
+    def _export_batches(self, query_str, params, writer, format, header, is_text):
+        """Exports the query results fetching the rows in batches.
+
+        The values are written the same way as PostgreSQL COPY does,
+        binary data as `\\x` followed by hex digits.
+        """
+        import csv
+
+        def convert(value):
+            if isinstance(value, (bytes, bytearray, memoryview)):
+                return '\\x' + bytes(value).hex()
+            return value
+
+        def escape(value):
+            if value is None:
+                return '\\N'
+            return (str(convert(value)).replace('\\', '\\\\').replace('\t', '\\t')
+                    .replace('\n', '\\n').replace('\r', '\\r'))
+
+        def write(lines):
+            writer.write(lines if is_text else lines.encode('utf-8'))
+
+        cursor = self._get_connection().cursor()
+        cursor.execute(query_str, tuple(params))
+
+        if format == 'csv':
+            lines = io.StringIO()
+            csv_writer = csv.writer(lines, lineterminator='\n')
+            if header:
+                csv_writer.writerow([col[0] for col in cursor.description])
+
+        while True:
+            rows = cursor.fetchmany(self.EXPORT_BATCH_SIZE)
+            if not rows:
+                break
+            if format == 'csv':
+                csv_writer.writerows([[convert(value) for value in row] for row in rows])
+                write(lines.getvalue())
+                lines.seek(0)
+                lines.truncate()
+            else:
+                write(''.join(['\t'.join([escape(value) for value in row]) + '\n'
+                               for row in rows]))
+
+    def poll_changes(self, query_str, watermark_column, interval=60.0, key_column=None,
+                     start=None, checkpoint=None, max_cycles=None, params=()):
+        """Polls a query for the new, and updated rows.
+
+        Each cycle fetches only the rows with the watermark column (like `updated_at`,
+        or a growing id) greater than the last one seen, so with an index on that
+        column its cost depends on the number of changed rows, not the table size.
+
+        Rows with the same watermark are handled in two ways:
+
+        - with `key_column`, the rows are ordered by the watermark and the key,
+          and the next cycle starts after the last seen (watermark, key) pair;
+          the key must grow for the rows added later with the same watermark,
+        - without it, the next cycle starts at the last seen watermark,
+          and the rows already returned with that watermark are skipped.
+
+        Rows with NULL watermark are never returned.
+
+        A row counts as seen when the next one is requested, so a row being processed
+        when the consumer fails, or the generator is closed, is returned again
+        by the next polling, and each row is returned at least once.
+
+        The transaction started by a cycle is rolled back after it, so the next cycle
+        sees the new rows. The connection is left alone when a transaction was already
+        open before the cycle, or when the consumer made changes with `query`,
+        these have to be committed by the consumer. The changes made directly
+        with the DBAPI connection are not tracked, so they should be committed
+        before the next row is requested.
+
+        Examples:
+            Process the new orders every 10 seconds, survive restarts:
+                for row in db.poll_changes("SELECT * FROM orders", 'updated_at', 10,
+                                           key_column='id', checkpoint='orders.json'):
+                    process(row)
+
+        Args:
+            query_str (str): SQL query returning the rows.
+            watermark_column (str): Name of the column with the watermark.
+            interval (float): Seconds to wait between the cycles.
+            key_column (str): Name of the column with a unique key.
+            start: Watermark to start after, the rows with this watermark
+                   are not returned. By default all the rows are returned.
+            checkpoint (str): Path to a JSON file with the last seen watermark.
+                              It's loaded at the start, if it exists,
+                              and saved after each cycle, and when the generator is closed.
+            max_cycles (int): Number of cycles to run, by default the polling never ends.
+            params (tuple): Params for the query.
+
+        Yields:
+            Row: The new, and updated rows.
+        """
+        import json
+        import os
+
+        watermark, key, seen = start, None, set()
+        if checkpoint is not None and os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                data = json.load(f)
+            watermark = _decode_value(data['watermark'])
+            key = _decode_value(data['key'])
+            seen = set(data['seen'])
+
+        def save():
+            if checkpoint is None:
+                return
+            data = {
+                'watermark': _encode_value(watermark),
+                'key': _encode_value(key),
+                'seen': sorted(seen),
+            }
+            with open(checkpoint + '.tmp', 'w') as f:
+                json.dump(data, f)
+            os.replace(checkpoint + '.tmp', checkpoint)
+
+        source = "SELECT * FROM ({}) _dbrows_changes".format(query_str)
+        ph = self._placeholder
+        order = watermark_column if key_column is None else "{}, {}".format(watermark_column, key_column)
+
+        cycle = 0
+        try:
+            while max_cycles is None or cycle < max_cycles:
+                if cycle:
+                    time.sleep(interval)
+                cycle += 1
+
+                if watermark is None:
+                    condition = "{} IS NOT NULL".format(watermark_column)
+                    cycle_params = ()
+                elif key_column is None:
+                    # without the seen rows, no row with the watermark was returned,
+                    # like for `start`
+                    condition = "{} {} {}".format(watermark_column, ">=" if seen else ">", ph)
+                    cycle_params = (watermark,)
+                elif key is None:
+                    condition = "{} > {}".format(watermark_column, ph)
+                    cycle_params = (watermark,)
+                else:
+                    condition = "{0} > {1} OR ({0} = {1} AND {2} > {1})".format(
+                        watermark_column, ph, key_column)
+                    cycle_params = (watermark, watermark, key)
+
+                was_in_transaction = (self._state.transaction_depth > 0
+                                      or self._in_transaction(self._get_connection()))
+                rows = self.query("{} WHERE {} ORDER BY {}".format(source, condition, order),
+                                  *(tuple(params) + cycle_params))
+                for row in rows:
+                    row_id = repr(row.values)
+                    if key_column is None and row[watermark_column] == watermark and row_id in seen:
+                        continue
+                    yield row
+
+                    # the consumer asked for the next row, so this one is processed
+                    if key_column is None:
+                        if row[watermark_column] != watermark:
+                            seen = set()
+                        seen.add(row_id)
+                    else:
+                        key = row[key_column]
+                    watermark = row[watermark_column]
+
+                if not was_in_transaction and not self._state.has_writes:
+                    self.rollback()
+                save()
+        finally:
+            save()
+
+    def _acquire_spare_connection(self):
+        """Returns an idle additional connection, opens a new one if needed."""
+        with self._spare_lock:
+            if self._spare_connections:
+                return self._spare_connections.pop()
+        return self._connect()
+
+    def _release_spare_connection(self, connection):
+        """Gives the additional connection back for the next calls."""
+        try:
+            connection.rollback()
+        except self._dbapi.Error:
+            connection.close()
+            return
+        with self._spare_lock:
+            self._spare_connections.append(connection)
 
     def close(self):
         """Closes the database connection."""
         self._open = False
-        self._connection.close()
+        if self._prewarm_thread is not None:
+            self._prewarm_thread.join()
+        with self._connection_lock:
+            if self._thread_safe:
+                connections = [connection for _, connection in self._thread_connections]
+                self._thread_connections = []
+            else:
+                connections = [self._state.connection] if self._state.connection else []
+            self._state.connection = None
+        for connection in connections:
+            connection.close()
+        with self._spare_lock:
+            spare, self._spare_connections = self._spare_connections, []
+        for connection in spare:
+            connection.close()
 
     def begin(self):
         """Starts a transaction."""
-        self._connection.begin()
+        self._get_connection().begin()
 
     def commit(self):
         """Commits a transaction."""
-        self._connection.commit()
+        if self._connection is not None:
+            try:
+                self._connection.commit()
+            finally:
+                # also a failed commit ends the transaction
+                self._forget_transaction()
 
     def rollback(self):
         """Rolls back a transaction."""
-        self._connection.rollback()
+        if self._connection is not None:
+            try:
+                self._connection.rollback()
+            finally:
+                self._forget_transaction()
+
+    def _forget_transaction(self):
+        """Marks the transaction of the calling thread as ended."""
+        self._state.in_transaction = False
+        self._state.has_writes = False
 
     @property
     def transaction(self):
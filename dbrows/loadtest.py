@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+"""Load test for dbrows.
+
+Runs a mix of operations on a database from many concurrent clients,
+and reports the throughput, latency percentiles and error rates as JSON.
+
+Examples:
+    Run the test against a SQLite file with 8 threads for 30 seconds:
+        python -m dbrows.loadtest --connstr sqlite:///tmp/load.sqlite --workers 8 --duration 30
+
+    Use processes, and only reads:
+        python -m dbrows.loadtest --mode processes --mix query=3,iterate=1
+
+    Without --connstr the PostgreSQL connection is made using
+    the DB_HOST, DB_USER, DB_PASS and DB_NAME environment variables.
+"""
+import io
+import json
+import math
+import random
+import time
+from collections import OrderedDict
+
+from dbrows import Database
+
+TABLE = "dbrows_loadtest"
+
+MODES = ("threads", "processes", "asyncio")
+
+DEFAULT_MIX = "query=5,iterate=2,transaction=1,fetch_by_keys=1,export=1"
+
+
+def setup(connstr, rows):
+    """Creates the table used by the operations, and fills it with the rows."""
+    with Database(connstr) as db:
+        ph = db._placeholder
+        with db.transaction:
+            db.query("DROP TABLE IF EXISTS {}".format(TABLE))
+            db.query("CREATE TABLE {} (id int PRIMARY KEY, grp int, payload text)".format(TABLE))
+            cursor = db._get_connection().cursor()
+            cursor.executemany(
+                "INSERT INTO {} (id, grp, payload) VALUES ({ph}, {ph}, {ph})".format(TABLE, ph=ph),
+                [(i, i % 100, "payload {}".format(i)) for i in range(rows)])
+
+
+def op_query(db, rnd, rows):
+    """Reads one row."""
+    db.query("SELECT payload FROM {} WHERE id = {}".format(TABLE, db._placeholder),
+             rnd.randrange(rows)).first
+
+
+def op_iterate(db, rnd, rows):
+    """Iterates through about one percent of the rows."""
+    for _ in db.query("SELECT id, payload FROM {} WHERE grp = {}".format(TABLE, db._placeholder),
+                      rnd.randrange(100)):
+        pass
+
+
+def op_transaction(db, rnd, rows):
+    """Updates one row, and commits."""
+    ph = db._placeholder
+    i = rnd.randrange(rows)
+    with db.transaction:
+        db.query("UPDATE {} SET payload = {} WHERE id = {}".format(TABLE, ph, ph),
+                 "payload {} {}".format(i, rnd.random()), i)
+
+
+def op_fetch_by_keys(db, rnd, rows):
+    """Reads a hundred random rows by their keys."""
+    db.fetch_by_keys(TABLE, 'id', [rnd.randrange(rows) for _ in range(100)])
+    db.rollback()
+
+
+def op_export(db, rnd, rows):
+    """Exports about one percent of the rows to csv."""
+    db.export("SELECT id, payload FROM {} WHERE grp = {}".format(TABLE, db._placeholder),
+              io.BytesIO(), rnd.randrange(100))
+    db.rollback()
+
+
+OPERATIONS = OrderedDict([
+    ('query', op_query),
+    ('iterate', op_iterate),
+    ('transaction', op_transaction),
+    ('fetch_by_keys', op_fetch_by_keys),
+    ('export', op_export),
+])
+
+
+def parse_mix(mix):
+    """Parses the operations mix.
+
+    Args:
+        mix (str): Comma separated operations with their weights, like `query=5,export=1`.
+
+    Returns:
+        OrderedDict: Operation name -> weight.
+
+    Raises:
+        ValueError if the mix is wrong.
+    """
+    weights = OrderedDict()
+    for item in mix.split(','):
+        name, _, weight = item.strip().partition('=')
+        if name not in OPERATIONS:
+            raise ValueError("Unknown operation '{}', use one of: {}."
+                             .format(name, ", ".join(OPERATIONS)))
+        weights[name] = int(weight) if weight else 1
+        if weights[name] < 0:
+            raise ValueError("The weight of '{}' can't be negative.".format(name))
+    if not any(weights.values()):
+        raise ValueError("The mix doesn't contain any operation.")
+    return weights
+
+
+def choose(rnd, weights):
+    """str: Name of a random operation from the mix."""
+    return rnd.choices(list(weights), weights=list(weights.values()))[0]
+
+
+def run_operation(db, name, rnd, rows, results):
+    """Runs the operation, and appends its latency and error to the results."""
+    start = time.perf_counter()
+    error = None
+    try:
+        OPERATIONS[name](db, rnd, rows)
+    except Exception as e:
+        error = "{}: {}".format(type(e).__name__, e)
+        try:
+            db.rollback()
+        except Exception:
+            pass
+    results.append((name, time.perf_counter() - start, error))
+
+
+def run_worker(db, weights, rows, duration, seed):
+    """Runs random operations until the duration passes.
+
+    Returns:
+        List[Tuple[str, float, str]]: Operation name, latency, and error for each operation.
+    """
+    rnd = random.Random(seed)
+    results = []
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        run_operation(db, choose(rnd, weights), rnd, rows, results)
+    return results
+
+
+def _run_process_worker(connstr, weights, rows, duration, seed):
+    with Database(connstr) as db:
+        return run_worker(db, weights, rows, duration, seed)
+
+
+def run_threads(connstr, weights, rows, duration, workers):
+    from concurrent.futures import ThreadPoolExecutor
+    with Database(connstr, thread_safe=True) as db:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(run_worker, db, weights, rows, duration, seed)
+                       for seed in range(workers)]
+            return [result for future in futures for result in future.result()]
+
+
+def run_processes(connstr, weights, rows, duration, workers):
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_run_process_worker, connstr, weights, rows, duration, seed)
+                   for seed in range(workers)]
+        return [result for future in futures for result in future.result()]
+
+
+def run_asyncio(connstr, weights, rows, duration, workers):
+    """Runs the operations as asyncio tasks.
+
+    The dbrows calls are blocking, so each of them is run in an executor.
+    """
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+
+    async def task(loop, executor, db, seed):
+        rnd = random.Random(seed)
+        results = []
+        end = time.perf_counter() + duration
+        while time.perf_counter() < end:
+            await loop.run_in_executor(executor, run_operation,
+                                       db, choose(rnd, weights), rnd, rows, results)
+        return results
+
+    async def main(db):
+        loop = asyncio.get_event_loop()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = await asyncio.gather(*[task(loop, executor, db, seed)
+                                             for seed in range(workers)])
+        return [result for task_results in results for result in task_results]
+
+    with Database(connstr, thread_safe=True) as db:
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(main(db))
+        finally:
+            loop.close()
+
+
+RUNNERS = {
+    "threads": run_threads,
+    "processes": run_processes,
+    "asyncio": run_asyncio,
+}
+
+
+def percentile(latencies, percent):
+    """Returns the percentile of the sorted latencies, using the nearest rank method."""
+    if not latencies:
+        return None
+    rank = max(int(math.ceil(percent / 100.0 * len(latencies))) - 1, 0)
+    return latencies[rank]
+
+
+def summarize(results, duration):
+    """Returns the statistics of the operation results.
+
+    Args:
+        results (List[Tuple[str, float, str]]): Results of the operations.
+        duration (float): Duration of the test in seconds.
+
+    Returns:
+        OrderedDict: Statistics, the latencies are in milliseconds.
+    """
+    def stats(items):
+        latencies = sorted(latency * 1000 for _, latency, _ in items)
+        errors = [error for _, _, error in items if error]
+        return OrderedDict([
+            ('count', len(items)),
+            ('errors', len(errors)),
+            ('error_rate', len(errors) / len(items) if items else 0.0),
+            ('throughput', len(items) / duration if duration else 0.0),
+            ('latency_ms', OrderedDict([
+                ('p50', percentile(latencies, 50)),
+                ('p95', percentile(latencies, 95)),
+                ('p99', percentile(latencies, 99)),
+                ('max', latencies[-1] if latencies else None),
+            ])),
+            ('error_samples', sorted(set(errors))[:5]),
+        ])
+
+    operations = OrderedDict()
+    for name in OPERATIONS:
+        items = [result for result in results if result[0] == name]
+        if items:
+            operations[name] = stats(items)
+
+    return OrderedDict([
+        ('total', stats(results)),
+        ('operations', operations),
+    ])
+
+
+def run(connstr, mode="threads", workers=4, duration=10.0, mix=DEFAULT_MIX, rows=10000):
+    """Runs the load test.
+
+    Args:
+        connstr (str): Connection string to a database.
+        mode (str): `threads`, `processes`, or `asyncio`.
+        workers (int): Number of concurrent clients.
+        duration (float): Duration of the test in seconds.
+        mix (str): Operations with their weights, like `query=5,export=1`.
+        rows (int): Number of rows in the test table.
+
+    Returns:
+        OrderedDict: The test configuration and statistics.
+
+    Raises:
+        ValueError if the arguments are wrong.
+    """
+    if mode not in RUNNERS:
+        raise ValueError("Unknown mode '{}', use one of: {}.".format(mode, ", ".join(MODES)))
+    if workers < 1:
+        raise ValueError("The number of workers must be greater than 0.")
+    weights = parse_mix(mix)
+
+    setup(connstr, rows)
+
+    start = time.perf_counter()
+    results = RUNNERS[mode](connstr, weights, rows, duration, workers)
+    elapsed = time.perf_counter() - start
+
+    report = OrderedDict([
+        ('config', OrderedDict([
+            ('engine', connstr.split(':', 1)[0]),
+            ('mode', mode),
+            ('workers', workers),
+            ('duration', duration),
+            ('mix', weights),
+            ('rows', rows),
+        ])),
+        ('elapsed', elapsed),
+    ])
+    report.update(summarize(results, elapsed))
+    return report
+
+
+def default_connstr():
+    """str: PostgreSQL connection string made of the environment variables used by the tests."""
+    from os import environ
+    return "postgresql://{}:{}@{}/{}".format(
+        environ.get("DB_USER"), environ.get("DB_PASS"),
+        environ.get("DB_HOST"), environ.get("DB_NAME"))
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="python -m dbrows.loadtest",
+                                     description="Load test for dbrows.")
+    parser.add_argument("--connstr", default=None,
+                        help="Connection string, by default made of DB_* environment variables.")
+    parser.add_argument("--mode", choices=MODES, default="threads")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds.")
+    parser.add_argument("--mix", default=DEFAULT_MIX,
+                        help="Operations with weights, default: {}.".format(DEFAULT_MIX))
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--output", default=None, help="JSON file, by default stdout.")
+    args = parser.parse_args(argv)
+
+    try:
+        report = run(connstr=args.connstr or default_connstr(), mode=args.mode,
+                     workers=args.workers, duration=args.duration, mix=args.mix, rows=args.rows)
+    except ValueError as e:
+        parser.error(str(e))
+
+    data = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(data + "\n")
+    else:
+        print(data)
+
+
+if __name__ == "__main__":
+    main()
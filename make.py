@@ -44,6 +44,32 @@ def make_env(
     return {key.upper(): value if value else "" for key, value in locals().items()}
 
 
+def make_envs(python_version, db_engines, db_version, omit_latest):
+    """Yields the environments for all the combinations of the given versions."""
+    if python_version == "all":
+        python_versions = PYTHON_VERSIONS
+    else:
+        python_versions = [python_version]
+
+    for dbengine in db_engines:
+
+        if db_version is None or db_version == "all":
+            dbversions = list(DB_ENGINES[dbengine])
+            if omit_latest:
+                dbversions.remove("latest")
+        else:
+            dbversions = [db_version]
+
+        for dbversion in dbversions:
+            for python_version in python_versions:
+
+                yield make_env(
+                    python_version=python_version,
+                    db_engine=dbengine,
+                    db_version=dbversion,
+                )
+
+
 # MAKE_BUILD_CMD = docker-compose -f docker-compose-$(DB_ENGINE).yml build --parallel db test
 # MAKE_TEST_RUN  = docker-compose -f docker-compose-$(DB_ENGINE).yml run test pytest .
 
@@ -84,6 +110,27 @@ def run_test(env):
     return run_cmd(cmd, env), env
 
 
+def run_loadtest(env, options):
+    resp = build_docker(env)
+    if resp.returncode != 0:
+        return resp, env
+
+    log_info(f"Running load test for: {get_info_str(env)}")
+
+    cmd = [
+        "docker-compose",
+        "-f",
+        "docker-compose-{DB_ENGINE}.yml".format(**env),
+        "run",
+    ]
+    services = ["test", "python", "-m", "dbrows.loadtest"] + options
+    cmd = cmd + services
+
+    log_debug(f"Running command {cmd}")
+
+    return run_cmd(cmd, env), env
+
+
 def build_docker(env):
     log_info(f"Building docker for: {get_info_str(env)}")
 
@@ -146,31 +193,10 @@ def test(omit_latest, debug, python_version, db_engine, db_version):
             )
             exit(1)
 
-    if python_version == "all":
-        python_versions = PYTHON_VERSIONS
-    else:
-        python_versions = [python_version]
-
     responses = []
-    for dbengine in db_engines:
-
-        if db_version is None or db_version == "all":
-            dbversions = DB_ENGINES[dbengine]
-            if omit_latest:
-                dbversions.remove("latest")
-        else:
-            dbversions = [db_version]
-
-        for dbversion in dbversions:
-            for python_version in python_versions:
-
-                env = make_env(
-                    python_version=python_version,
-                    db_engine=dbengine,
-                    db_version=dbversion,
-                )
-                log_debug(f"Using env: {env}")
-                responses += [run_test(env)]
+    for env in make_envs(python_version, db_engines, db_version, omit_latest):
+        log_debug(f"Using env: {env}")
+        responses += [run_test(env)]
 
     ok_msg = click.style("OK", fg="green")
     err_msg = click.style("ERROR", fg="red")
@@ -196,7 +222,64 @@ def test(omit_latest, debug, python_version, db_engine, db_version):
         log_error("-" * 80)
 
 
+@click.command()
+@click.option("--db-version", required=False, default="all")
+# dbrows.loadtest connects to PostgreSQL, there is no MySQL driver in dbrows
+@click.option(
+    "--db-engine", required=False, default="postgres", type=click.Choice(["postgres"])
+)
+@click.option("--python-version", required=False, default="all")
+@click.option("--debug/--no-debug")
+@click.option("--omit-latest", required=False, default=True)
+@click.option("--mode", required=False, default="threads")
+@click.option("--workers", required=False, default=4)
+@click.option("--duration", required=False, default=10.0)
+@click.option("--mix", required=False, default=None)
+@click.option("--output-dir", required=False, default=".")
+def loadtest(
+    output_dir,
+    mix,
+    duration,
+    workers,
+    mode,
+    omit_latest,
+    debug,
+    python_version,
+    db_engine,
+    db_version,
+):
+    """Run the load test, and save the JSON reports."""
+    global DEBUG
+    DEBUG = DEBUG or debug
+
+    options = ["--mode", mode, "--workers", str(workers), "--duration", str(duration)]
+    if mix:
+        options += ["--mix", mix]
+
+    failed = False
+    for env in make_envs(python_version, [db_engine], db_version, omit_latest):
+        log_debug(f"Using env: {env}")
+        res, env = run_loadtest(env, options)
+        if res.returncode != 0:
+            failed = True
+            log_error(get_info_str(env) + " ERROR")
+            print(res.stderr)
+            print(res.stdout)
+            continue
+
+        path = "{}/loadtest-{DB_ENGINE}-{DB_VERSION}-python{PYTHON_VERSION}.json".format(
+            output_dir, **env
+        )
+        with open(path, "w") as f:
+            f.write(res.stdout)
+        log_info(f"{get_info_str(env)} report saved to {path}")
+
+    if failed:
+        exit(1)
+
+
 commands.add_command(test)
+commands.add_command(loadtest)
 
 if __name__ == "__main__":
     commands()
@@ -83,6 +83,44 @@ class TestDatabaseConnection(unittest.TestCase):
         with pytest.raises(dbapi.OperationalError):
             Database('postgresql://bad:something/nodb')
 
+    def test_lazy_bad_connection(self):
+        db = Database('postgresql://bad:something/nodb', lazy=True)
+        with pytest.raises(dbapi.OperationalError):
+            db.query("SELECT 1")
+        assert db.connection_stats.attempts == 1
+        assert db.connection_stats.failures == 1
+
+    def test_reconnect_after_terminated_backend(self):
+        with Database(connstr, reconnect_attempts=3, reconnect_delay=0.01) as db:
+            with Database(connstr) as admin:
+                admin.query("SELECT pg_terminate_backend(%s)", db._connection.get_backend_pid())
+            assert db.query("SELECT 42").first[0] == 42
+            assert db.connection_stats.reconnects == 1
+
+    def test_reconnect_after_select(self):
+        # psycopg2 starts a transaction also for a SELECT, and can't tell its state
+        # after the backend is gone
+        with Database(connstr, reconnect_attempts=3, reconnect_delay=0.01) as db:
+            assert db.query("SELECT 1").first[0] == 1
+            with Database(connstr) as admin:
+                admin.query("SELECT pg_terminate_backend(%s)", db._connection.get_backend_pid())
+            assert db.query("SELECT 42").first[0] == 42
+            assert db.query("SELECT 43").first[0] == 43
+            assert db.connection_stats.reconnects == 1
+
+    def test_no_reconnect_with_uncommitted_writes(self):
+        with Database(connstr, reconnect_attempts=3, reconnect_delay=0.01) as db:
+            db.query("CREATE TEMP TABLE reconnect_test (i int)")
+            with Database(connstr) as admin:
+                admin.query("SELECT pg_terminate_backend(%s)", db._connection.get_backend_pid())
+            with pytest.raises(dbapi.Error):
+                db.query("SELECT 42")
+            assert db.connection_stats.reconnects == 0
+            with pytest.raises(dbapi.Error):
+                db.rollback()
+            assert db.query("SELECT 42").first[0] == 42
+            assert db.connection_stats.reconnects == 1
+
 
 class TestDatabase(unittest.TestCase):
 
@@ -214,6 +252,66 @@ class TestDatabase(unittest.TestCase):
                 assert dc == Decimal('0.{}'.format(i))
                 assert repr(row) == '<Row {"dc": "%s", "i": %s}>' % (dc, i)
 
+    def test_iterating_with_prefetch(self):
+        with Database(connstr) as db:
+            rows = db.query("SELECT g FROM generate_series(1, 5000) g ORDER BY g", prefetch=2)
+            assert rows._cursor.name is not None  # rows are fetched from the server in batches
+            assert [row['g'] for row in rows] == list(range(1, 5001))
+
+    def test_prefetch_for_query_without_rows(self):
+        with Database(connstr) as db:
+            with db.transaction(rollback=True):
+                rows = db.query("CREATE TEMPORARY TABLE prefetch_test (i int)", prefetch=2)
+                assert rows._cursor.name is None
+
+    def test_result_too_large(self):
+        from dbrows import ResultTooLargeError
+        with Database(connstr) as db:
+            rows = db.query("SELECT g, repeat('x', 20000) FROM generate_series(1, 10) g",
+                            max_result_bytes=10000)
+            with pytest.raises(ResultTooLargeError):
+                for row in rows:
+                    pass
+
+    def test_streamed_result_larger_than_budget(self):
+        with Database(connstr) as db:
+            rows = db.query("SELECT g, repeat('x', 100) FROM generate_series(1, 1000) g ORDER BY g",
+                            max_result_bytes=10000)
+            assert rows._cursor.name is not None
+            assert [row[0] for row in rows] == list(range(1, 1001))
+            assert not rows.spilled
+            assert 0 < rows.peak_bytes <= 10000
+
+    def test_result_spilled_to_file(self):
+        with Database(connstr, max_result_bytes=10000, spill=True) as db:
+            rows = db.query("SELECT g, repeat('x', 100) FROM generate_series(1, 1000) g ORDER BY g")
+            # the limit set for the database doesn't change the cursor
+            assert rows._cursor.name is None
+            assert rows.size == 1000
+            assert [row[0] for row in rows] == list(range(1, 1001))
+            assert rows.spilled
+            assert rows._cursor.closed
+
+    def test_client_cursor_result_too_large(self):
+        from dbrows import ResultTooLargeError
+        with Database(connstr, max_result_bytes=10000) as db:
+            rows = db.query("""-- not streamed
+                SELECT g, repeat('x', 100) FROM generate_series(1, 1000) g""",
+                max_result_bytes=10000)
+            assert rows._cursor.name is None
+            with pytest.raises(ResultTooLargeError):
+                rows.first
+
+    def test_commit_while_iterating_streamed_result(self):
+        with Database(connstr) as db:
+            ids = []
+            for row in db.query("SELECT g FROM generate_series(1, 3000) g ORDER BY g",
+                                prefetch=2, max_result_bytes=10 ** 6):
+                with db.transaction:
+                    db.query("UPDATE test SET i = i WHERE i = %s", row[0])
+                ids.append(row[0])
+            assert ids == list(range(1, 3001))
+
     def test_query_results_with_arguments_multiple_rows(self):
         with Database(connstr) as db:
             rows = db.query("""select i, dc from test where i = %s or i = %s""", 2, 3)
@@ -268,3 +366,153 @@ class TestDatabase(unittest.TestCase):
         with Database(connstr) as db:
             with pytest.raises(ValueError):
                 db.transaction(rollback=True, commit=True)
+
+
+class TestFetchByKeys(unittest.TestCase):
+
+    def setUp(self):
+        with Database(connstr) as db:
+            with db.transaction:
+                drop_table_if_exists(db, 'keys_test')
+                db.query("CREATE TABLE keys_test (id int, parent int, t text)")
+                for i in range(1, 101):
+                    db.query("INSERT INTO keys_test(id, parent, t) VALUES(%s, %s, %s)",
+                             i, i % 10, 't{}'.format(i))
+
+    def test_fetch_by_keys_from_table(self):
+        with Database(connstr) as db:
+            rows = db.fetch_by_keys('keys_test', 'id', [3, 1, 3, 1000])
+            assert sorted(rows.keys()) == [1, 3]
+            assert isinstance(rows[3], Row)
+            assert rows[3]['t'] == 't3'
+
+    def test_fetch_by_keys_from_query_in_chunks(self):
+        with Database(connstr) as db:
+            rows = db.fetch_by_keys("SELECT id, t FROM keys_test WHERE id > %s", 'id',
+                                    range(1, 101), chunk=7, params=(50,))
+            assert sorted(rows.keys()) == list(range(51, 101))
+            assert rows[51].col_names == ('id', 't')
+
+    def test_fetch_by_keys_many_in_parallel(self):
+        with Database(connstr) as db:
+            rows = db.fetch_by_keys('keys_test', 'parent', range(10),
+                                    chunk=2, many=True, workers=3)
+            assert sorted(rows.keys()) == list(range(10))
+            assert all(len(children) == 10 for children in rows.values())
+            assert sorted(row['id'] for row in rows[0]) == list(range(10, 101, 10))
+
+
+class TestExport(unittest.TestCase):
+
+    def setUp(self):
+        with Database(connstr) as db:
+            with db.transaction:
+                drop_table_if_exists(db, 'export_test')
+                db.query("CREATE TABLE export_test (i int, t text)")
+                db.query("INSERT INTO export_test(i, t) SELECT g, 't' || g FROM generate_series(1, 100) g")
+
+    def test_export_csv_with_header(self):
+        import io
+        with Database(connstr) as db:
+            out = io.StringIO()
+            written = db.export("SELECT i, t FROM export_test WHERE i <= %s ORDER BY i", out, 2,
+                                header=True)
+            assert out.getvalue() == "i,t\n1,t1\n2,t2\n"
+            assert written == len(out.getvalue())
+
+    def test_export_gzip_text(self):
+        import io
+        import gzip
+        with Database(connstr) as db:
+            out = io.BytesIO()
+            progress = []
+            written = db.export("SELECT i, NULL, t FROM export_test ORDER BY i", out, format='text',
+                                gzip=True, buffer_size=100, progress=progress.append)
+            data = gzip.decompress(out.getvalue())
+            assert data.splitlines()[0] == b"1\t\\N\tt1"
+            assert len(data.splitlines()) == 100
+            assert written == len(data)
+            assert progress[-1] == written
+
+    def test_export_binary(self):
+        import io
+        with Database(connstr) as db:
+            out = io.BytesIO()
+            db.export("SELECT i FROM export_test", out, format='binary')
+            assert out.getvalue().startswith(b"PGCOPY\n\xff\r\n\x00")
+
+
+class TestThreadSafe(unittest.TestCase):
+
+    def test_backend_per_thread(self):
+        import threading
+        with Database(connstr, thread_safe=True) as db:
+            pids = []
+            barrier = threading.Barrier(3)
+
+            def work():
+                pids.append(db.query("SELECT pg_backend_pid()").first[0])
+                barrier.wait()
+
+            threads = [threading.Thread(target=work) for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert len(set(pids)) == 3
+
+
+class TestPollChanges(unittest.TestCase):
+
+    def setUp(self):
+        with Database(connstr) as db:
+            with db.transaction:
+                drop_table_if_exists(db, 'changes_test')
+                db.query("CREATE TABLE changes_test (id int, updated timestamptz)")
+                db.query("""INSERT INTO changes_test(id, updated)
+                            SELECT g, '2020-01-01'::timestamptz + (g / 2) * interval '1 hour'
+                            FROM generate_series(1, 5) g""")
+
+    def test_poll_with_checkpoint(self):
+        import os
+        import tempfile
+        checkpoint = os.path.join(tempfile.mkdtemp(), 'changes.json')
+
+        def poll():
+            with Database(connstr) as db:
+                return [row['id'] for row in db.poll_changes(
+                    "SELECT * FROM changes_test", 'updated', interval=0, key_column='id',
+                    max_cycles=1, checkpoint=checkpoint)]
+
+        assert poll() == [1, 2, 3, 4, 5]
+        assert poll() == []
+        with Database(connstr) as db:
+            with db.transaction:
+                db.query("INSERT INTO changes_test(id, updated) SELECT 6, max(updated) FROM changes_test")
+        assert poll() == [6]
+
+    def test_poll_twice_on_one_database(self):
+        from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+
+        def poll(db, start=None):
+            return [row['id'] for row in db.poll_changes(
+                "SELECT * FROM changes_test", 'updated', interval=0, key_column='id',
+                start=start, max_cycles=1)]
+
+        with Database(connstr) as db:
+            # with a transaction left open, the second polling wouldn't see the new row
+            db._connection.set_session(isolation_level='REPEATABLE READ')
+            assert poll(db) == [1, 2, 3, 4, 5]
+            assert db._connection.info.transaction_status == TRANSACTION_STATUS_IDLE
+            with Database(connstr) as other:
+                with other.transaction:
+                    other.query("INSERT INTO changes_test(id, updated) VALUES(6, '2021-01-01')")
+            assert poll(db, start=datetime.datetime(2020, 6, 1, tzinfo=datetime.timezone.utc)) == [6]
+
+    def test_poll_keeps_consumer_writes(self):
+        with Database(connstr) as db:
+            for row in db.poll_changes("SELECT * FROM changes_test", 'updated', interval=0,
+                                       key_column='id', max_cycles=2):
+                db.query("UPDATE changes_test SET id = -id WHERE id = %s", row['id'])
+            db.commit()
+            assert db.query("SELECT count(*) FROM changes_test WHERE id < 0").first[0] == 5
@@ -0,0 +1,601 @@
+from dbrows import Database, Row
+import unittest
+
+
+class SqliteTestCase(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        import os
+        fd, self.path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        self.connstr = 'sqlite://' + self.path
+
+        with Database(self.connstr) as db:
+            with db.transaction:
+                db.query("CREATE TABLE test (id int, parent int, t text)")
+                for i in range(1, 101):
+                    db.query("INSERT INTO test(id, parent, t) VALUES(?, ?, ?)",
+                             i, i % 10, 't{}'.format(i))
+
+    def tearDown(self):
+        import os
+        os.remove(self.path)
+
+
+class TestFetchByKeys(SqliteTestCase):
+
+    def test_fetch_by_keys_from_table(self):
+        with Database(self.connstr) as db:
+            rows = db.fetch_by_keys('test', 'id', [3, 1, 3, 1000])
+            assert sorted(rows.keys()) == [1, 3]
+            assert isinstance(rows[3], Row)
+            assert rows[3]['t'] == 't3'
+
+    def test_fetch_by_keys_from_query_in_chunks(self):
+        with Database(self.connstr) as db:
+            rows = db.fetch_by_keys("SELECT id, t FROM test WHERE id > ?", 'id',
+                                    range(1, 101), chunk=7, params=(50,))
+            assert sorted(rows.keys()) == list(range(51, 101))
+            assert rows[51].col_names == ('id', 't')
+
+    def test_fetch_by_keys_many_in_parallel(self):
+        with Database(self.connstr) as db:
+            rows = db.fetch_by_keys('test', 'parent', range(10),
+                                    chunk=2, many=True, workers=3)
+            assert sorted(rows.keys()) == list(range(10))
+            assert all(len(children) == 10 for children in rows.values())
+            assert sorted(row['id'] for row in rows[0]) == list(range(10, 101, 10))
+
+    def test_fetch_by_keys_in_parallel_in_memory(self):
+        with Database("sqlite://:memory:") as db:
+            db.query("CREATE TABLE t (id int)")
+            for i in range(10):
+                db.query("INSERT INTO t(id) VALUES(?)", i)
+            rows = db.fetch_by_keys('t', 'id', range(10), chunk=2, workers=2)
+            assert sorted(rows.keys()) == list(range(10))
+
+    def test_fetch_by_keys_wrong_chunk(self):
+        with Database(self.connstr) as db:
+            with self.assertRaises(ValueError):
+                db.fetch_by_keys('test', 'id', [1], chunk=0)
+
+
+class TestConnecting(SqliteTestCase):
+
+    def test_lazy_connection(self):
+        with Database(self.connstr, lazy=True) as db:
+            assert db.connection_stats.attempts == 0
+            assert db.query("SELECT count(*) FROM test").first[0] == 100
+            assert db.connection_stats.attempts == 1
+            assert db.connection_stats.failures == 0
+            assert db.connection_stats.last_time is not None
+
+    def test_prewarm(self):
+        with Database(self.connstr, lazy=True, prewarm=True) as db:
+            db._prewarm_thread.join()
+            assert db.connection_stats.attempts == 1
+            assert db.query("SELECT count(*) FROM test").first[0] == 100
+            assert db.connection_stats.attempts == 1
+
+    def test_reconnect_dead_connection(self):
+        with Database(self.connstr, reconnect_attempts=3, reconnect_delay=0.01) as db:
+            db._connection.close()
+            assert db.query("SELECT count(*) FROM test").first[0] == 100
+            assert db.connection_stats.attempts == 2
+            assert db.connection_stats.reconnects == 1
+
+    def test_no_reconnect_in_transaction(self):
+        with Database(self.connstr, reconnect_attempts=3, reconnect_delay=0.01) as db:
+            with self.assertRaises(db._dbapi.ProgrammingError):
+                with db.transaction(rollback=True):
+                    db._connection.close()
+                    db.query("SELECT count(*) FROM test")
+            assert db.connection_stats.reconnects == 0
+
+    def test_no_reconnect_in_implicit_transaction(self):
+        with Database(self.connstr, reconnect_attempts=3, reconnect_delay=0.01) as db:
+            db.query("DELETE FROM test")
+            db._connection.close()
+            with self.assertRaises(db._dbapi.ProgrammingError):
+                db.query("SELECT count(*) FROM test")
+            assert db.connection_stats.reconnects == 0
+
+    def test_reconnect_after_rollback(self):
+        with Database(self.connstr, reconnect_attempts=3, reconnect_delay=0.01) as db:
+            db.query("DELETE FROM test")
+            db._connection.close()
+            with self.assertRaises(db._dbapi.ProgrammingError):
+                db.query("SELECT count(*) FROM test")
+            with self.assertRaises(db._dbapi.ProgrammingError):
+                db.rollback()
+            assert db.query("SELECT count(*) FROM test").first[0] == 100
+            assert db.connection_stats.reconnects == 1
+
+    def test_reconnect_after_select(self):
+        with Database(self.connstr, reconnect_attempts=3, reconnect_delay=0.01) as db:
+            db.query("SELECT count(*) FROM test").first
+            db._connection.close()
+            assert db.query("SELECT count(*) FROM test").first[0] == 100
+
+    def test_prewarm_doesnt_touch_used_connection(self):
+        class SlowPrewarmDatabase(Database):
+            VALIDATION_QUERY = """
+                WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c WHERE x < 300000)
+                SELECT count(*) FROM c"""
+
+        with SlowPrewarmDatabase(self.connstr, lazy=True, prewarm=True) as db:
+            db.query("DELETE FROM test WHERE id > 50")
+            db._prewarm_thread.join()
+            db.commit()
+        with Database(self.connstr) as db:
+            assert db.query("SELECT count(*) FROM test").first[0] == 50
+
+    def test_no_reconnect_for_writes(self):
+        with Database(self.connstr, reconnect_attempts=3, reconnect_delay=0.01) as db:
+            db._connection.close()
+            with self.assertRaises(db._dbapi.ProgrammingError):
+                db.query("DELETE FROM test")
+            assert db.connection_stats.reconnects == 0
+
+
+class TestExport(SqliteTestCase):
+
+    def test_export_csv_to_text_file(self):
+        import io
+        with Database(self.connstr) as db:
+            out = io.StringIO()
+            written = db.export("SELECT id, t FROM test WHERE id <= ? ORDER BY id", out, 2,
+                                header=True)
+            assert out.getvalue() == "id,t\n1,t1\n2,t2\n"
+            assert written == len(out.getvalue())
+
+    def test_export_text_format(self):
+        import io
+        with Database(self.connstr) as db:
+            out = io.BytesIO()
+            db.export("SELECT 1, NULL, 'a\tb\\c'", out, format='text')
+            assert out.getvalue() == b"1\t\\N\ta\\tb\\\\c\n"
+
+    def test_export_bytes(self):
+        import io
+        with Database(self.connstr) as db:
+            out = io.StringIO()
+            db.export("SELECT ?, 1", out, b'\x00\xff')
+            assert out.getvalue() == "\\x00ff,1\n"
+            out = io.StringIO()
+            db.export("SELECT ?, 1", out, b'\x00\xff', format='text')
+            assert out.getvalue() == "\\\\x00ff\t1\n"
+
+    def test_export_gzip_with_progress(self):
+        import io
+        import gzip
+        with Database(self.connstr) as db:
+            db.EXPORT_BATCH_SIZE = 10
+            out = io.BytesIO()
+            progress = []
+            written = db.export("SELECT id, t FROM test ORDER BY id", out,
+                                gzip=True, buffer_size=100, progress=progress.append)
+            data = gzip.decompress(out.getvalue())
+            assert data.splitlines()[-1] == b"100,t100"
+            assert len(data.splitlines()) == 100
+            assert written == len(data)
+            assert len(progress) > 1
+            assert progress[-1] == written
+
+    def test_export_binary_format(self):
+        import io
+        from dbrows import WrongOperationError
+        with Database(self.connstr) as db:
+            with self.assertRaises(WrongOperationError):
+                db.export("SELECT id FROM test", io.BytesIO(), format='binary')
+            with self.assertRaises(ValueError):
+                db.export("SELECT id FROM test", io.BytesIO(), format='xml')
+
+
+class TestThreadSafe(SqliteTestCase):
+
+    def run_threads(self, count, target, *args):
+        import threading
+        threads = [threading.Thread(target=target, args=args) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def test_connection_per_thread(self):
+        with Database(self.connstr, thread_safe=True) as db:
+            import threading
+            connections = []
+            barrier = threading.Barrier(3)
+
+            def connect():
+                connections.append(db._get_connection())
+                barrier.wait()
+
+            self.run_threads(3, connect)
+            assert len(set(map(id, connections))) == 3
+            assert db._connection not in connections
+            assert db.connection_stats.attempts == 4
+
+            # the connections of the finished threads are reused
+            self.run_threads(3, lambda: db.query("SELECT 1"))
+            assert db.connection_stats.attempts == 4
+
+    def test_transaction_scoped_to_thread(self):
+        with Database(self.connstr, thread_safe=True) as db:
+            depths = []
+            with db.transaction(rollback=True):
+                db.query("DELETE FROM test")
+                self.run_threads(1, lambda: depths.append(db._state.transaction_depth))
+                assert db.query("SELECT count(*) FROM test").first[0] == 0
+            assert depths == [0]
+            assert db.query("SELECT count(*) FROM test").first[0] == 100
+
+    def usable_cpus(self):
+        import os
+        if hasattr(os, 'sched_getaffinity'):
+            return len(os.sched_getaffinity(0))
+        return os.cpu_count() or 1
+
+    def create_big_table(self):
+        with Database(self.connstr) as db:
+            with db.transaction:
+                db.query("CREATE TABLE big (x int)")
+                db._connection.executemany("INSERT INTO big(x) VALUES(?)",
+                                           [(i,) for i in range(20000)])
+
+    def read_throughput(self, db, threads, queries=50):
+        """Runs the queries in the threads, checks the results, and returns queries per second."""
+        import time
+
+        expected = [(i, len(range(0, 20000, i)), sum(range(0, 20000, i)))
+                    for i in range(2, 12)]
+
+        def work(results):
+            for n in range(queries):
+                i, count, total = expected[n % len(expected)]
+                row = db.query("SELECT count(*), sum(x) FROM big WHERE x % ? = 0", i).first
+                results.append(row.values == (count, total))
+
+        results = []
+        start = time.perf_counter()
+        self.run_threads(threads, work, results)
+        duration = time.perf_counter() - start
+        assert len(results) == threads * queries
+        assert all(results)
+        return len(results) / duration
+
+    def test_stress_reads(self):
+        self.create_big_table()
+        with Database(self.connstr, thread_safe=True) as db:
+            self.read_throughput(db, threads=8)
+
+    def test_read_scaling(self):
+        cpus = self.usable_cpus()
+        if cpus < 2:
+            self.skipTest("needs at least 2 usable CPUs, got {}".format(cpus))
+
+        self.create_big_table()
+        threads = min(cpus, 4)
+        with Database(self.connstr, thread_safe=True) as db:
+            self.read_throughput(db, threads=1)  # warm up the page cache
+            single = self.read_throughput(db, threads=1)
+            multi = self.read_throughput(db, threads=threads)
+
+        # sqlite3 releases the GIL while running a query, so reads should scale near linearly
+        assert multi / single >= 0.7 * threads
+
+    def test_reconnect_doesnt_block_other_threads(self):
+        import threading
+        import time
+
+        with Database(self.connstr, thread_safe=True, reconnect_attempts=1,
+                      reconnect_delay=1.0) as db:
+            started = threading.Event()
+
+            def reconnect():
+                db._get_connection().close()
+                started.set()
+                db.query("SELECT count(*) FROM test")
+
+            reconnecting = threading.Thread(target=reconnect)
+            reconnecting.start()
+            started.wait()
+            time.sleep(0.1)
+
+            durations = []
+
+            def connect():
+                start = time.perf_counter()
+                db.query("SELECT 1")
+                durations.append(time.perf_counter() - start)
+
+            self.run_threads(1, connect)
+            reconnecting.join()
+            assert durations[0] < 0.5
+            assert db.connection_stats.reconnects == 1
+
+
+class TestPrefetch(SqliteTestCase):
+
+    def test_prefetch_all_rows(self):
+        with Database(self.connstr) as db:
+            rows = db.query("SELECT id, t FROM test ORDER BY id", prefetch=2)
+            assert [row['id'] for row in rows] == list(range(1, 101))
+
+    def test_prefetch_stops_early(self):
+        import threading
+        with Database(self.connstr) as db:
+            threads = threading.active_count()
+            rows = iter(db.query("SELECT id FROM test ORDER BY id", prefetch=1))
+            assert next(rows)['id'] == 1
+            assert threading.active_count() == threads + 1
+            rows.close()
+            assert threading.active_count() == threads
+
+    def test_prefetch_stopped_releases_bytes(self):
+        import time
+        with Database(self.connstr) as db:
+            rows = db.query("SELECT id FROM test ORDER BY id", prefetch=1, max_result_bytes=1000)
+            batches = iter(rows)
+            assert next(batches)['id'] == 1
+            time.sleep(0.2)  # the next batches fill the queue, and wait for a place in it
+            batches.close()
+            assert rows._held_bytes == 0
+
+    def test_prefetch_passes_errors(self):
+        from dbrows import RowCollection
+
+        class BrokenCursor(object):
+            rowcount = 20
+
+            def __init__(self):
+                self.batches = [[(1,)] * 10]
+
+            def fetchmany(self, size):
+                if not self.batches:
+                    raise RuntimeError("connection lost")
+                return self.batches.pop()
+
+        rows = RowCollection(BrokenCursor(), col_names=('i',), prefetch=3)
+        fetched = []
+        with self.assertRaises(RuntimeError):
+            for row in rows:
+                fetched.append(row)
+        assert len(fetched) == 10
+
+
+class TestLoadTest(SqliteTestCase):
+
+    def test_run_modes(self):
+        from dbrows import loadtest
+        for mode in loadtest.MODES:
+            report = loadtest.run(self.connstr, mode=mode, workers=2, duration=0.2, rows=200)
+            assert report['config']['mode'] == mode
+            assert report['total']['count'] > 0
+            assert report['total']['errors'] == 0
+            assert set(report['total']['latency_ms']) == {'p50', 'p95', 'p99', 'max'}
+            assert set(report['operations']) <= set(loadtest.OPERATIONS)
+
+    def test_json_output(self):
+        import io
+        import json
+        from contextlib import redirect_stdout
+        from dbrows import loadtest
+        out = io.StringIO()
+        with redirect_stdout(out):
+            loadtest.main(["--connstr", self.connstr, "--duration", "0.1",
+                           "--rows", "100", "--mix", "query"])
+        report = json.loads(out.getvalue())
+        assert list(report['operations']) == ['query']
+
+    def test_wrong_mix(self):
+        from dbrows import loadtest
+        with self.assertRaises(ValueError):
+            loadtest.parse_mix("query=1,drop_database=1")
+
+    def test_percentile(self):
+        from dbrows.loadtest import percentile
+        latencies = list(range(1, 101))
+        assert percentile(latencies, 50) == 50
+        assert percentile(latencies, 99) == 99
+        assert percentile(latencies, 100) == 100
+        assert percentile([], 50) is None
+
+
+class TestResultMemoryBudget(SqliteTestCase):
+
+    WIDE_QUERY = "SELECT id, ? AS w FROM test ORDER BY id"
+
+    def test_result_too_large(self):
+        from dbrows import ResultTooLargeError
+        with Database(self.connstr, max_result_bytes=2000) as db:
+            rows = db.query(self.WIDE_QUERY, 'x' * 3000)
+            with self.assertRaises(ResultTooLargeError):
+                for row in rows:
+                    pass
+
+    def test_result_within_budget(self):
+        with Database(self.connstr) as db:
+            rows = db.query("SELECT id, t FROM test ORDER BY id", max_result_bytes=10 ** 6)
+            assert len([row for row in rows]) == 100
+            assert 0 < rows.peak_bytes <= 10 ** 6
+            assert not rows.spilled
+
+    def test_streamed_result_larger_than_budget(self):
+        # only the rows held in memory are counted, not all of the streamed ones
+        with Database(self.connstr) as db:
+            self.create_rows(db, 2000)
+            for prefetch in (0, 2):
+                rows = db.query("SELECT id, t FROM big ORDER BY id",
+                                prefetch=prefetch, max_result_bytes=2000)
+                assert len([row for row in rows]) == 2000
+                assert 0 < rows.peak_bytes <= 2000
+                assert not rows.spilled
+                assert rows._held_bytes == 0
+
+    def test_no_spill_for_streamed_result(self):
+        from dbrows import ResultTooLargeError
+        with Database(self.connstr, max_result_bytes=2000, spill=True) as db:
+            rows = db.query(self.WIDE_QUERY, 'x' * 3000)
+            with self.assertRaises(ResultTooLargeError):
+                rows.first
+            assert not rows.spilled
+
+    def buffered_rows(self, count, **kwargs):
+        """RowCollection reading from a cursor which holds all the rows, like on PostgreSQL."""
+        from dbrows import RowCollection
+
+        class BufferedCursor(object):
+            description = (('id',), ('t',))
+
+            def __init__(self, rows):
+                self.rows = rows
+                self.rowcount = len(rows)
+                self.closed = False
+
+            def fetchmany(self, size):
+                rows, self.rows = self.rows[:size], self.rows[size:]
+                return rows
+
+            def close(self):
+                self.closed = True
+
+        cursor = BufferedCursor([(i, 'row {}'.format(i)) for i in range(count)])
+        return RowCollection(cursor, col_names=('id', 't'), buffered=True, **kwargs)
+
+    def test_buffered_result_too_large(self):
+        from dbrows import ResultTooLargeError
+        rows = self.buffered_rows(100, max_bytes=2000)
+        with self.assertRaises(ResultTooLargeError):
+            rows.first
+
+    def test_buffered_result_within_budget(self):
+        rows = self.buffered_rows(100, max_bytes=10 ** 6)
+        assert [row['id'] for row in rows] == list(range(100))
+        # the rows left in the cursor are counted
+        assert 100 * 100 < rows.peak_bytes <= 10 ** 6
+        assert rows._held_bytes == 0
+        assert rows._cursor.closed
+
+    def test_spill_to_file(self):
+        rows = self.buffered_rows(1000, max_bytes=2000, spill=True)
+        assert rows.first['id'] == 0
+        assert rows.spilled
+        assert rows._cursor.closed
+        assert [row['id'] for row in rows] == list(range(1, 1000))
+        # the rows left in the cursor are counted until they are moved to the file
+        assert rows.peak_bytes > 1000 * 100
+        assert rows._held_bytes == rows._cached_bytes
+
+    def test_spill_with_prefetch(self):
+        rows = self.buffered_rows(1000, max_bytes=2000, spill=True, prefetch=2)
+        assert [row['id'] for row in rows] == list(range(1000))
+        assert rows.spilled
+        assert rows._held_bytes == 0
+
+    def create_rows(self, db, count):
+        with db.transaction:
+            db.query("CREATE TABLE big (id int, t text)")
+            db._connection.executemany("INSERT INTO big(id, t) VALUES(?, ?)",
+                                       [(i, 'row {}'.format(i)) for i in range(count)])
+
+
+class TestPollChanges(SqliteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.checkpoint = self.path + '.json'
+        with Database(self.connstr) as db:
+            with db.transaction:
+                db.query("CREATE TABLE changes (id int, updated int, t text)")
+                for i in range(1, 6):
+                    db.query("INSERT INTO changes(id, updated, t) VALUES(?, ?, ?)", i, i // 2, 'a')
+
+    def tearDown(self):
+        import os
+        if os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+        super().tearDown()
+
+    def insert(self, *rows):
+        with Database(self.connstr) as db:
+            with db.transaction:
+                for row in rows:
+                    db.query("INSERT INTO changes(id, updated, t) VALUES(?, ?, ?)", *row)
+
+    def poll(self, **kwargs):
+        with Database(self.connstr) as db:
+            return [row['id'] for row in db.poll_changes(
+                "SELECT * FROM changes", 'updated', interval=0, max_cycles=1,
+                checkpoint=self.checkpoint, **kwargs)]
+
+    def test_poll_with_key(self):
+        assert self.poll(key_column='id') == [1, 2, 3, 4, 5]
+        assert self.poll(key_column='id') == []
+
+        # the same watermark as the last seen row, and a newer one
+        self.insert((6, 2, 'b'), (7, 3, 'c'))
+        assert self.poll(key_column='id') == [6, 7]
+
+    def test_poll_without_key(self):
+        assert sorted(self.poll()) == [1, 2, 3, 4, 5]
+        assert self.poll() == []
+
+        self.insert((6, 2, 'b'), (7, 3, 'c'))
+        assert self.poll() == [6, 7]
+        self.insert((8, 3, 'd'))
+        assert self.poll() == [8]
+
+    def test_poll_stopped_early(self):
+        with Database(self.connstr) as db:
+            changes = db.poll_changes("SELECT * FROM changes", 'updated', interval=0,
+                                      key_column='id', checkpoint=self.checkpoint)
+            assert [next(changes)['id'], next(changes)['id']] == [1, 2]
+            changes.close()
+        # the row in flight wasn't processed
+        assert self.poll(key_column='id') == [2, 3, 4, 5]
+
+    def test_poll_consumer_failed(self):
+        import os
+        for kwargs in ({'key_column': 'id'}, {}):
+            with Database(self.connstr) as db:
+                ids = []
+                with self.assertRaises(ValueError):
+                    for row in db.poll_changes("SELECT * FROM changes", 'updated', interval=0,
+                                               checkpoint=self.checkpoint, **kwargs):
+                        if row['id'] == 3:
+                            raise ValueError(row['id'])
+                        ids.append(row['id'])
+            assert ids == [1, 2]
+            assert sorted(self.poll(**kwargs)) == [3, 4, 5]
+            os.remove(self.checkpoint)
+
+    def test_poll_keeps_consumer_writes(self):
+        with Database(self.connstr) as db:
+            db.query("CREATE TABLE log (id int)")
+            db.commit()
+            for row in db.poll_changes("SELECT * FROM changes", 'updated', interval=0,
+                                       key_column='id', max_cycles=2):
+                db.query("INSERT INTO log(id) VALUES(?)", row['id'])
+            db.commit()
+            assert db.query("SELECT count(*) FROM log").first[0] == 5
+
+    def test_poll_after_start(self):
+        import os
+        assert self.poll(start=1) == [4, 5]
+        assert self.poll() == []
+        os.remove(self.checkpoint)
+        assert self.poll(start=1, key_column='id') == [4, 5]
+
+    def test_poll_many_cycles(self):
+        with Database(self.connstr) as db:
+            ids = []
+            for row in db.poll_changes("SELECT * FROM changes WHERE t = ?", 'updated',
+                                       interval=0, key_column='id', start=1,
+                                       max_cycles=3, params=('a',)):
+                ids.append(row['id'])
+                if row['id'] == 5:
+                    self.insert((6, 9, 'a'), (7, 9, 'b'))
+            assert ids == [4, 5, 6]